@@ -2,8 +2,23 @@ import scrapy
 import psycopg2
 import string
 import datetime
+import hashlib
+import math
+import zlib
+import re
+import time
+import itertools
+from twisted.enterprise import adbapi
+from md_court_scraper.items import RawCaseItem, SearchCellItem
+from md_court_scraper.rawhtml import createTables, contentHash
 
 # EXAMPLE: scrapy crawl cases -a dbhost=localhost -a db=test -a dbuser=user -a dbpassword=password -a start_date=YYYY/MM/DD -a end_date=YYYY/MM/DD
+# Add -a seen=bloom to track saved cases in a Bloom filter instead of a set
+# Add -a shard=0 -a shards=4 to crawl one quarter of the search cells, one shard per process or machine
+# Searches that hit SEARCH_RESULT_LIMIT are split by county, then by the last name's first two characters
+# Add -a sessions=8 to spread requests over 8 server sessions instead of 4
+# EXAMPLE: scrapy crawl cases -a dbhost=localhost -a db=test -a dbuser=user -a dbpassword=password -a recrawl=1 -a recrawl_after=7 -a recrawl_ttl=365
+# Recrawl mode refetches cases that aren't disposed, if fetched over recrawl_after days ago, and any case fetched over recrawl_ttl days ago
 
 BASE_URL = 'http://casesearch.courts.state.md.us'
 DISCLAIMER_URL = '/casesearch/processDisclaimer.jis'
@@ -13,6 +28,13 @@ COMPANY_TYPES = ['Y', 'N']
 CASE_TYPES = ['CIVIL', 'CRIMINAL', 'TRAFFIC', 'CP']
 COURT_SYSTEMS = ['C', 'D']
 LETTER_MAX = 26
+# Second last name characters to split by, names like O'BRIEN, A-1 TOWING, and A & B LLC don't have a letter there
+NAME_CHARS = string.ascii_lowercase + string.digits + " '-&.,"
+COUNTIES = ['ALLEGANY COUNTY', 'ANNE ARUNDEL COUNTY', 'BALTIMORE CITY', 'BALTIMORE COUNTY', 'CALVERT COUNTY', 'CAROLINE COUNTY', 'CARROLL COUNTY', 'CECIL COUNTY', 'CHARLES COUNTY', 'DORCHESTER COUNTY', 'FREDERICK COUNTY', 'GARRETT COUNTY', 'HARFORD COUNTY', 'HOWARD COUNTY', 'KENT COUNTY', 'MONTGOMERY COUNTY', 'PRINCE GEORGE\'S COUNTY', 'QUEEN ANNE\'S COUNTY', 'SOMERSET COUNTY', 'ST. MARY\'S COUNTY', 'TALBOT COUNTY', 'WASHINGTON COUNTY', 'WICOMICO COUNTY', 'WORCESTER COUNTY']
+CLOSED_STATUSES = ['CLOSED', 'CLOSED/INACTIVE', 'INACTIVE']
+
+# Cases that aren't disposed, having no disposition date and no closed status, or an undisposed charge
+OPEN_CASE = "(cases.disposition_date IS NULL AND upper(coalesce(cases.status, '')) <> ALL(%(closed)s) OR EXISTS (SELECT 1 FROM charges WHERE charges.case_id = cases.case_id AND charges.disposition IS NULL))"
 
 # Compute list of dates between two
 def daterange(start_date, end_date):
@@ -36,21 +58,97 @@ def parseDate(paramstr):
 def combineDate(date):
 	return str(date.month) + '/' + str(date.day) + '/' + str(date.year)
 
+# Get the key identifying one search in the date x company x letter x case type x court grid
+def cellKey(date, company, letter, case, court):
+	return '|'.join((date.isoformat(), company, letter, case, court))
+
+# Get the key for a search cell minus its date, which empty-search history is kept by
+def cellPattern(company, letter, case, court):
+	return '|'.join((company, letter, case, court))
+
+# Assign a search cell to a shard, the same way on every node
+def cellShard(cell, shards):
+	return zlib.crc32(cell.encode('utf-8')) % shards
+
+# Get the number of results a search found from the results banner
+def countResults(response, caseLinks):
+	banner = ' '.join(response.css('span.pagebanner ::text').extract())
+	match = re.search(r'([\d,]+) items? found', banner)
+	if match:
+		return int(match.group(1).replace(',', ''))
+	# Banners without a number mean one page or less
+	return len(caseLinks)
+
+# A server session that has accepted the disclaimer, with the requests waiting on it while it's renewed
+class Session(object):
+	def __init__(self, id):
+		self.id = id
+		self.cookie = None
+		self.renewing = True
+		self.waiting = []
+
+# Compact membership test for case IDs that may give false positives but never false negatives
+class BloomFilter(object):
+	def __init__(self, capacity, errorRate=0.001):
+		self.size = max(64, int(-capacity * math.log(errorRate) / math.log(2) ** 2))
+		self.hashCount = max(1, int(round(self.size / capacity * math.log(2))))
+		self.bits = bytearray((self.size + 7) // 8)
+
+	# Get bit positions by double hashing one digest
+	def positions(self, key):
+		digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashCount)]
+
+	def add(self, key):
+		for pos in self.positions(key):
+			self.bits[pos >> 3] |= 1 << (pos & 7)
+
+	def __contains__(self, key):
+		return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
 # Get case details HTML files
 class CasesSpider(scrapy.Spider):
 	name = 'cases'
-	cookie = None
+	sessions = 4
+	recrawl = None
+	recrawl_after = 1
+	recrawl_ttl = 0
 	conn = None
 	cur = None
+	dbpool = None
+	seen = 'set'
+	seenCases = None
+	shard = 0
+	shards = 1
 
 	# Connect to PostgreSQL and start crawler on disclaimer page
 	def start_requests(self):
 		self.connectToDatabase(self)
+		createTables(self.cur)
+		self.conn.commit()
+		if self.recrawl:
+			# Only saved cases are fetched, so nothing about searches is needed
+			self.seenCases = set()
+			self.searchStats = {}
+		else:
+			self.loadSeenCases()
+			self.loadCompletedCells()
+			self.loadSearchStats()
+		# Case IDs requested during this crawl
+		self.requestedCases = set()
+		# Unfinished requests per search cell
+		self.cellPending = {}
 
-		return [ scrapy.Request(
-			BASE_URL + DISCLAIMER_URL,
-			callback = self.acceptDisclaimer
-		)]
+		# Thread pool for queries that shouldn't block the reactor
+		self.dbpool = adbapi.ConnectionPool('psycopg2', host=self.dbhost, database=self.db, user=self.dbuser, password=self.dbpassword, cp_reconnect=True)
+
+		# Searches start once every session has accepted the disclaimer
+		self.sessionPool = [Session(i) for i in range(int(self.sessions))]
+		self.nextSession = 0
+		self.searching = False
+		return [self.disclaimerRequest(session) for session in self.sessionPool]
 
 	# Connect to PostgreSQL
 	def connectToDatabase(self, *args):
@@ -61,21 +159,180 @@ class CasesSpider(scrapy.Spider):
 			self.logger.critical('Unable to connect to PostgreSQL')
 		self.cur = self.conn.cursor()
 
+	# Preload the case IDs already in rawcases so most links need no lookup
+	def loadSeenCases(self):
+		if self.seen == 'bloom':
+			self.cur.execute('SELECT COUNT(*) FROM rawcases')
+			# Leave room for the cases this crawl will add
+			self.seenCases = BloomFilter(max(1000000, self.cur.fetchone()[0] * 2))
+		else:
+			self.seenCases = set()
+		cur = self.conn.cursor('seen_cases')
+		cur.itersize = 100000
+		cur.execute('SELECT case_id FROM rawcases')
+		for row in cur:
+			self.seenCases.add(row[0])
+		cur.close()
+		self.conn.commit()
+		self.logger.info('Loaded saved case IDs into %s', self.seen)
+
+	# Load the search cells earlier crawls finished so they can be skipped
+	def loadCompletedCells(self):
+		try:
+			self.cur.execute('CREATE TABLE IF NOT EXISTS search_cells (cell text PRIMARY KEY, completed_at timestamp DEFAULT now())')
+			self.conn.commit()
+		except psycopg2.IntegrityError:
+			# Another shard created it at the same time
+			self.conn.rollback()
+		self.cur.execute('SELECT cell FROM search_cells')
+		self.completedCells = {row[0] for row in self.cur.fetchall()}
+		self.conn.commit()
+		self.logger.info('Crawling shard %s of %s, %s search cells already completed', self.shard, self.shards, len(self.completedCells))
+
+	# Load the patterns whose searches have always come back empty
+	def loadSearchStats(self):
+		self.resultLimit = self.settings.getint('SEARCH_RESULT_LIMIT', 500)
+		skipAfter = self.settings.getint('SEARCH_SKIP_EMPTY_AFTER', 0)
+		try:
+			self.cur.execute('CREATE TABLE IF NOT EXISTS search_stats (pattern text PRIMARY KEY, searches integer, results integer)')
+			self.conn.commit()
+		except psycopg2.IntegrityError:
+			self.conn.rollback()
+		self.emptyPatterns = set()
+		if skipAfter > 0:
+			self.cur.execute('SELECT pattern FROM search_stats WHERE results = 0 AND searches >= %s', (skipAfter,))
+			self.emptyPatterns = {row[0] for row in self.cur.fetchall()}
+		self.conn.commit()
+		# Searches and results per pattern in this crawl, written when it closes
+		self.searchStats = {}
+		self.logger.info('Skipping %s search patterns with no results in %s or more searches', len(self.emptyPatterns), skipAfter)
+
+	# Report on the sessions and add this crawl's search results to the history
+	def closed(self, reason):
+		stats = self.crawler.stats
+		for session in self.sessionPool:
+			self.logger.info('Session %s: %s responses, %s saved cases, expired %s times', session.id, stats.get_value('session/%s/responses' % session.id, 0), stats.get_value('session/%s/saved' % session.id, 0), stats.get_value('session/%s/expired' % session.id, 0))
+		if not self.searchStats:
+			return
+		rows = [(pattern, searches, results) for pattern, (searches, results) in self.searchStats.items()]
+		self.cur.executemany('INSERT INTO search_stats (pattern, searches, results) VALUES (%s, %s, %s) ON CONFLICT (pattern) DO UPDATE SET searches = search_stats.searches + EXCLUDED.searches, results = search_stats.results + EXCLUDED.results', rows)
+		self.conn.commit()
+		self.logger.info('Saved search history for %s patterns', len(rows))
+
+	# Count a finished request against its search cell, returning an item once the whole cell is done
+	def finishCellRequest(self, response):
+		cell = response.meta.get('cell')
+		if cell is None:
+			return []
+		self.cellPending[cell] -= 1
+		if self.cellPending[cell] > 0:
+			return []
+		del self.cellPending[cell]
+		self.logger.debug('Completed search cell %s', cell)
+		return [SearchCellItem(cell=cell)]
+
+	# Meta for a request made in a session
+	# Cookies are sent by hand so Scrapy's single cookie jar doesn't mix sessions,
+	# and redirects come back to the callback so an expired session can be spotted
+	def sessionMeta(self, session, **meta):
+		meta.update({
+			'session': session.id,
+			'dont_merge_cookies': True,
+			'dont_redirect': True,
+			'handle_httpstatus_list': [301, 302, 303]
+		})
+		return meta
+
+	# Get the next session, round robin, passing over sessions being renewed unless they all are
+	def pickSession(self):
+		for i in range(len(self.sessionPool)):
+			session = self.sessionPool[self.nextSession % len(self.sessionPool)]
+			self.nextSession += 1
+			if not session.renewing:
+				break
+		return session
+
+	# Get the session a response was made in, counting the response against it
+	def responseSession(self, response):
+		session = self.sessionPool[response.meta['session']]
+		self.crawler.stats.inc_value('session/%s/responses' % session.id)
+		return session
+
+	# Start or renew a session by getting the disclaimer page
+	def disclaimerRequest(self, session):
+		return scrapy.Request(
+			BASE_URL + DISCLAIMER_URL,
+			meta = {
+				'session': session.id,
+				'dont_merge_cookies': True
+			},
+			callback = self.acceptDisclaimer,
+			dont_filter = True
+		)
+
 	# Spoof form submission
 	def acceptDisclaimer(self, response):
-		self.cookie = response.headers['Set-Cookie']
+		session = self.sessionPool[response.meta['session']]
+		cookies = [cookie.split(b';')[0].decode('latin-1') for cookie in response.headers.getlist('Set-Cookie')]
+		if cookies:
+			session.cookie = '; '.join(cookies)
 
 		yield scrapy.FormRequest(
 			BASE_URL + DISCLAIMER_URL,
+			headers = {
+				'Cookie': session.cookie
+			},
 			formdata = {
 				'action': 'Continue',
 				'disclaimer': 'Y'
 			},
-			callback = self.doSearches
+			meta = {
+				'session': session.id,
+				'dont_merge_cookies': True
+			},
+			callback = self.sessionAccepted,
+			dont_filter = True
 		 )
 
+	# Send a session's waiting requests, starting the searches once every session is ready
+	def sessionAccepted(self, response):
+		session = self.sessionPool[response.meta['session']]
+		session.renewing = False
+		self.crawler.stats.inc_value('session/%s/accepted' % session.id)
+		self.logger.info('Session %s accepted the disclaimer', session.id)
+		waiting = session.waiting
+		session.waiting = []
+		for request in waiting:
+			request.headers['Cookie'] = session.cookie
+		if not self.searching and not any(other.renewing for other in self.sessionPool):
+			self.searching = True
+			return itertools.chain(waiting, self.doRecrawl() if self.recrawl else self.doSearches(response))
+		return waiting
+
+	# Check whether the server sent a response back to the disclaimer
+	def sessionExpired(self, response):
+		location = response.headers.get('Location', b'').decode('latin-1')
+		return 'disclaimer' in location.lower() or b'name="disclaimer"' in response.body
+
+	# Hold the request until its session has accepted the disclaimer again
+	def renewSession(self, response, session):
+		request = response.request.replace(dont_filter=True)
+		# Sent with a cookie the session has since replaced, so just send it again with the new one
+		if not session.renewing and (request.headers.get('Cookie') or b'').decode('latin-1') != (session.cookie or ''):
+			request.headers['Cookie'] = session.cookie
+			return [request]
+		self.crawler.stats.inc_value('session/%s/expired' % session.id)
+		session.waiting.append(request)
+		if session.renewing:
+			return []
+		session.renewing = True
+		self.logger.info('Session %s expired, accepting the disclaimer again', session.id)
+		return [self.disclaimerRequest(session)]
+
 	# Iterate thru field ranges and get results
 	def doSearches(self, response):
+		shard = int(self.shard)
+		shards = int(self.shards)
 		for date in daterange(parseDate(self.start_date), parseDate(self.end_date)):
 			dateStr = combineDate(date)
 			self.logger.debug('Now searching for exact date: %s', dateStr)
@@ -88,92 +345,213 @@ class CasesSpider(scrapy.Spider):
 						self.logger.debug('Now searching in category: %s', case)
 						for court in COURT_SYSTEMS:
 							self.logger.debug('Now searching in system: %s', 'Circuit' if court == 'C' else 'District')
-							yield scrapy.FormRequest(
-								BASE_URL + SEARCH_URL,
-								headers = {
-									'Cookie': self.cookie
-								},
-								formdata = {
-									'action': 'Search',
-									'company': company,
-									'countyName': '',
-									'courtSystem': court,
-									'filingDate': dateStr,
-									'filingEnd': '',
-									'filingStart': '',
-									'firstName': '',
-									'lastName': letterStr,
-									'middleName':'',
-									'partyType': '',
-									'site': case,
-								},
-								callback = self.parseResults
-							)
+							# Skip cells owned by other shards, already finished, or that never have results
+							cell = cellKey(date, company, letterStr, case, court)
+							if cellShard(cell, shards) != shard or cell in self.completedCells:
+								continue
+							if cellPattern(company, letterStr, case, court) in self.emptyPatterns:
+								continue
+							self.cellPending[cell] = 1
+							yield self.searchRequest(cell, (dateStr, company, letterStr, case, court, ''), self.pickSession())
+
+	# Fetch the detail pages of saved cases that may have changed
+	def doRecrawl(self):
+		conditions = ['rawcases.fetched_at < now() - %(after)s * interval \'1 day\' AND ' + OPEN_CASE]
+		if float(self.recrawl_ttl) > 0:
+			conditions.append('rawcases.fetched_at < now() - %(ttl)s * interval \'1 day\'')
+		# Pages saved before URLs were kept can't be fetched directly
+		cur = self.conn.cursor('recrawl_cases')
+		cur.itersize = 10000
+		cur.execute('SELECT rawcases.case_id, rawcases.url FROM rawcases JOIN cases ON cases.case_id = rawcases.case_id WHERE rawcases.url IS NOT NULL AND (' + ' OR '.join(conditions) + ')', {'after': float(self.recrawl_after), 'ttl': float(self.recrawl_ttl), 'closed': CLOSED_STATUSES})
+		count = 0
+		for case_id, url in cur:
+			count += 1
+			session = self.pickSession()
+			yield scrapy.Request(
+				url,
+				headers = {
+					'Cookie': session.cookie
+				},
+				meta = self.sessionMeta(session),
+				callback = self.saveCase
+			)
+		cur.close()
+		self.conn.commit()
+		self.logger.info('Requested %s saved cases to recrawl', count)
+
+	# Build the search form request for a cell or part of one
+	def searchRequest(self, cell, search, session):
+		dateStr, company, lastName, case, court, county = search
+		return scrapy.FormRequest(
+			BASE_URL + SEARCH_URL,
+			headers = {
+				'Cookie': session.cookie
+			},
+			formdata = {
+				'action': 'Search',
+				'company': company,
+				'countyName': county,
+				'courtSystem': court,
+				'filingDate': dateStr,
+				'filingEnd': '',
+				'filingStart': '',
+				'firstName': '',
+				'lastName': lastName,
+				'middleName':'',
+				'partyType': '',
+				'site': case,
+			},
+			meta = self.sessionMeta(session,
+				cell = cell,
+				search = search
+			),
+			callback = self.parseResults
+		)
+
+	# Split a search that hit the result limit into narrower ones, or return none if it can't be narrowed
+	def refineSearch(self, response, caseLinks):
+		search = response.meta.get('search')
+		if response.meta.get('Sub_Page') or search is None:
+			return []
+		dateStr, company, lastName, case, court, county = search
+		count = countResults(response, caseLinks)
+		# Keep history for the unrefined searches only
+		if len(lastName) == 1 and not county:
+			stats = self.searchStats.setdefault(cellPattern(company, lastName, case, court), [0, 0])
+			stats[0] += 1
+			stats[1] += count
+		if count < self.resultLimit:
+			return []
+		cell = response.meta.get('cell')
+		# Every case has a county, so that split can't lose any
+		if not county:
+			self.logger.info('Refining %s by county (%s results)', cell, count)
+			searches = [(dateStr, company, lastName, case, court, name) for name in COUNTIES]
+		# One-letter names still won't match any of these
+		elif len(lastName) == 1:
+			self.logger.info('Refining %s %s by last name prefix (%s results)', cell, county, count)
+			searches = [(dateStr, company, lastName + char, case, court, county) for char in NAME_CHARS]
+		else:
+			self.logger.warning('Search %s %s %s is still cut off at %s results', cell, lastName, county, count)
+			return []
+		return [self.searchRequest(cell, search, self.pickSession()) for search in searches]
 
 	# Extract case detail links from results pages
 	def parseResults(self, response, *args):
-		# Redo request if response was not OK
+		session = self.responseSession(response)
+		if self.sessionExpired(response):
+			return self.renewSession(response, session)
+		# Failures are retried or given up on by BackoffRetryMiddleware, so this leaves the cell unfinished
 		if response.status != 200:
-			yield response.request
-			return
-		# Look for <a> in results table
-		caseLinks = response.css('table.results a::attr(href)').extract()
+			self.logger.warning('Unexpected status %s for %s', response.status, response.url)
+			return []
+		# Look for <a> in results table, skipping the sorting links
+		links = response.css('table.results a::attr(href)').extract()
+		caseLinks = [href for href in links if 'inquiry-results' not in href]
+		refinements = self.refineSearch(response, caseLinks)
+		# Sets are exact, so only Bloom filter hits need checking in the DB
+		seenIds = [extractCaseId(href) for href in caseLinks if extractCaseId(href) in self.seenCases]
+		if self.seen != 'bloom' or not seenIds:
+			return self.followResults([(case_id,) for case_id in seenIds], response, links, caseLinks, refinements)
+		# Check which cases have already been saved in one query off the reactor thread
+		d = self.dbpool.runQuery('SELECT case_id FROM rawcases WHERE case_id = ANY(%s)', (seenIds,))
+		d.addCallback(self.timeLookup, time.time())
+		d.addCallback(self.followResults, response, links, caseLinks, refinements)
+		d.addErrback(self.lookupFailed, response)
+		return d
+
+	# Follow the case links that haven't been saved and any additional results pages or narrower searches
+	def followResults(self, rows, response, links, caseLinks, refinements):
+		requests = []
+		cell = response.meta.get('cell')
+		savedIds = {row[0] for row in rows}
 		for href in caseLinks:
-			# Skip if it's just a sorting link
-			if 'inquiry-results' in href: continue
-			# Make sure the case hasn't already been saved
 			case_id = extractCaseId(href)
-			try:
-				self.cur.execute('SELECT EXISTS(SELECT 1 FROM rawcases WHERE case_id = %s)', (case_id,))
-			except:
-				self.logger.error('Failed to perform case_id lookup in rawcases')
-				self.connectToDatabase()
-				self.parseResults(self, response)
-				return
-			if not self.cur.fetchone()[0]:
+			if case_id in savedIds:
+				self.logger.info('Skipped %s (%s remaining)', case_id, len(self.crawler.engine.slot.scheduler))
+			# Leave cases another search already requested to that search
+			elif case_id not in self.requestedCases:
+				self.requestedCases.add(case_id)
 				# If not GET the inquiry-details page
-				yield response.follow(
+				session = self.pickSession()
+				requests.append(response.follow(
 					href,
 					headers = {
-						'Cookie': self.cookie
+						'Cookie': session.cookie
 					},
+					meta = self.sessionMeta(session,
+						cell = cell
+					),
 					callback = self.saveCase
-				)
-			else:
-				self.logger.info('Skipped %s (%s remaining)', case_id, len(self.crawler.engine.slot.scheduler))
+				))
 
+		# Narrower searches replace the later pages of a cut off one
+		if refinements:
+			requests.extend(refinements)
 		# Generate requests for additional results pages from the original one
-		if not response.meta.get('Sub_Page') and len(caseLinks) > 0:
+		elif not response.meta.get('Sub_Page') and len(links) > 0:
 			pageLinks = set(response.css('span.pagelinks a::attr(href)').extract())
+			# Results pages stay in the session that ran the search
+			session = self.sessionPool[response.meta['session']]
 			for href in pageLinks:
-				yield response.follow(
+				requests.append(response.follow(
 					href,
 					headers = {
-						'Cookie': self.cookie
-					},
-					meta = {
-						'Sub_Page': True
+						'Cookie': session.cookie
 					},
+					meta = self.sessionMeta(session,
+						Sub_Page = True,
+						cell = cell,
+						search = response.meta.get('search')
+					),
 					callback = self.parseResults
-				)
+				))
+
+		# The cell is done once its pages and cases are
+		if cell is not None:
+			self.cellPending[cell] += len(requests)
+		return requests + self.finishCellRequest(response)
 
-	# Insert case details page HTML into DB
+	# Record how long a lookup took, including waiting for a DB thread
+	def timeLookup(self, rows, start):
+		self.crawler.stats.inc_value('db/lookup_seconds', time.time() - start)
+		return rows
+
+	# Redo the results page if the case_id lookup failed, up to RETRY_TIMES times
+	def lookupFailed(self, failure, response):
+		self.logger.error('Failed to perform case_id lookup in rawcases: %s', failure.getErrorMessage())
+		retries = response.meta.get('lookup_retries', 0) + 1
+		if retries > self.settings.getint('RETRY_TIMES', 2):
+			self.logger.error('Giving up on %s after %s failed lookups', response.url, retries)
+			return []
+		request = response.request.replace(dont_filter=True)
+		request.meta['lookup_retries'] = retries
+		return [request]
+
+	# Send case details page HTML to the DB pipeline
 	def saveCase(self, response, *args):
-		# Redo request if response was not OK
+		session = self.responseSession(response)
+		if self.sessionExpired(response):
+			for request in self.renewSession(response, session):
+				yield request
+			return
+		# Failures are retried or given up on by BackoffRetryMiddleware, so this leaves the cell unfinished
 		if response.status != 200:
-			yield response.request
+			self.logger.warning('Unexpected status %s for %s', response.status, response.url)
 			return
-		# Get case ID and execute query
+		# Get case ID
 		try:
 			case_id = extractCaseId(response.url)
 		except:
 			self.logger.error('Failed to get case data for %s', response.url)
+			for item in self.finishCellRequest(response):
+				yield item
 			return
-		try:
-			self.cur.execute('INSERT INTO rawcases (case_id, html) VALUES (%s, %s)', (case_id, response.text))
-			self.conn.commit()
-			self.logger.info('Saved %s (%s remaining)', case_id, len(self.crawler.engine.slot.scheduler))
-		except:
-			self.logger.error('Failed to insert row for %s', case_id)
-			self.connectToDatabase()
-			self.saveCase(self, response)
+		# Leave the insert to the pipeline
+		self.seenCases.add(case_id)
+		self.crawler.stats.inc_value('session/%s/saved' % session.id)
+		self.logger.info('Saved %s (%s remaining)', case_id, len(self.crawler.engine.slot.scheduler))
+		yield RawCaseItem(case_id=case_id, url=response.url, html=response.text, html_hash=contentHash(response.text))
+		# After the case so the pipeline writes the cell in the same or a later batch
+		for item in self.finishCellRequest(response):
+			yield item
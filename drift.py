@@ -0,0 +1,50 @@
+import threading
+from collections import Counter
+
+# Parsed data that never reaches the database, counted per layout as {(layout, kind, table, label): count}
+# Kinds are 'section' for headers not in HEADER_MAP, 'label' for labels not in ATTRIBUTE_MAP that
+# don't match a column either, 'column' for mapped attributes their table has no column for,
+# and 'value' for values that couldn't be converted and were stored as NULL
+counts = Counter()
+lock = threading.Lock()
+
+KIND_NAMES = {
+    'section': 'unmapped sections',
+    'label': 'unmapped labels',
+    'column': 'attributes with no column',
+    'value': 'values that could not be converted'
+}
+
+# Add what was dropped from one case
+def add(layout, dropped):
+    with lock:
+        for kind, table, label in dropped:
+            counts[(layout, kind, table, label)] += 1
+
+# Get and clear this process's counts
+def take():
+    global counts
+    with lock:
+        taken = counts
+        counts = Counter()
+    return taken
+
+# Add counts taken from a parser process
+def merge(taken):
+    with lock:
+        counts.update(taken)
+
+# Print everything that was dropped, most frequent first within each layout
+def report():
+    if not counts:
+        print('Parser drift: nothing dropped')
+        return
+    print('Parser drift: %s dropped sections, fields, and values' % sum(counts.values()))
+    for layout in sorted(set(key[0] for key in counts)):
+        print('  %s' % layout)
+        for kind in KIND_NAMES:
+            entries = sorted(((count, table, label) for (entryLayout, entryKind, table, label), count in counts.items() if entryLayout == layout and entryKind == kind), reverse=True)
+            if entries:
+                print('    %s:' % KIND_NAMES[kind])
+                for count, table, label in entries:
+                    print('      %8d  %s' % (count, label if kind == 'section' else '%s: %s' % (table, label)))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+# Smallest download delay worth setting, below this it's dropped to zero
+MIN_DELAY = 0.25
+
+
+# Find the most concurrency the site sustains without manual tuning, AIMD style
+# Every ADAPTIVE_INTERVAL seconds concurrency goes up by one while latency and errors stay
+# under target and is halved when they don't, then download delay is added once it's at the floor
+class AdaptiveThrottle(object):
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        # Both set the slots' download delay
+        if settings.getbool('AUTOTHROTTLE_ENABLED'):
+            raise NotConfigured('AdaptiveThrottle and AutoThrottle can\'t both be enabled')
+        self.crawler = crawler
+        self.floor = settings.getint('ADAPTIVE_CONCURRENCY_MIN', 4)
+        self.ceiling = settings.getint('ADAPTIVE_CONCURRENCY_MAX', 64)
+        self.targetLatency = settings.getfloat('ADAPTIVE_TARGET_LATENCY', 2.0)
+        self.maxErrorRate = settings.getfloat('ADAPTIVE_ERROR_RATE', 0.05)
+        self.maxDelay = settings.getfloat('ADAPTIVE_MAX_DELAY', 10)
+        self.interval = settings.getfloat('ADAPTIVE_INTERVAL', 5)
+        # Responses needed before a window counts
+        self.minSamples = settings.getint('ADAPTIVE_MIN_SAMPLES', 20)
+        # Statuses that mean the site is struggling, rather than that a page is missing
+        self.overloadCodes = [int(code) for code in settings.getlist('RETRY_HTTP_CODES')]
+        self.concurrency = min(max(settings.getint('CONCURRENT_REQUESTS'), self.floor), self.ceiling)
+        self.delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.timer = None
+        self.responses = 0
+        self.latency = 0.0
+        # Downloader counts at the end of the last window
+        self.lastCounts = (0, 0, 0)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        throttle = cls(crawler)
+        crawler.signals.connect(throttle.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(throttle.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(throttle.response_received, signal=signals.response_received)
+        return throttle
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.apply()
+        self.timer = task.LoopingCall(self.adjust)
+        self.timer.start(self.interval, now=False)
+        spider.logger.info('Adaptive throttle starting at concurrency %s, delay %.2fs (floor %s, ceiling %s)', self.concurrency, self.delay, self.floor, self.ceiling)
+
+    def spider_closed(self, spider):
+        if self.timer and self.timer.running:
+            self.timer.stop()
+
+    # Only responses that make it out of the downloader middlewares get here, so this is just for latency
+    def response_received(self, response, request, spider):
+        self.responses += 1
+        self.latency += request.meta.get('download_latency', 0)
+
+    # Decide on the next concurrency and delay from the last window
+    def adjust(self):
+        # The downloader's counts include responses that are retried and connection errors
+        stats = self.crawler.stats
+        overloaded = sum(stats.get_value('downloader/response_status_count/%s' % code, 0) for code in self.overloadCodes)
+        counts = (stats.get_value('downloader/response_count', 0), overloaded, stats.get_value('downloader/exception_count', 0))
+        responses, overloaded, exceptions = (count - last for count, last in zip(counts, self.lastCounts))
+        samples = responses + exceptions
+        if samples < self.minSamples:
+            return
+        self.lastCounts = counts
+        errorRate = (overloaded + exceptions) / samples
+        latency = self.latency / self.responses if self.responses else 0.0
+        self.responses = 0
+        self.latency = 0.0
+
+        concurrency = self.concurrency
+        delay = self.delay
+        if errorRate > self.maxErrorRate or latency > self.targetLatency:
+            # Multiplicative decrease, slowing down further once there's no concurrency to give up
+            if concurrency > self.floor:
+                concurrency = max(self.floor, concurrency // 2)
+            else:
+                delay = min(self.maxDelay, max(delay * 2, MIN_DELAY))
+        elif delay > 0:
+            # Take delay back off before adding concurrency
+            delay = delay / 2 if delay / 2 >= MIN_DELAY else 0.0
+        elif concurrency < self.ceiling:
+            # Additive increase
+            concurrency += 1
+        if (concurrency, delay) == (self.concurrency, self.delay):
+            return
+        self.spider.logger.info('Adaptive throttle: concurrency %s -> %s, delay %.2fs -> %.2fs (error rate %.1f%%, latency %.2fs over %s responses)', self.concurrency, concurrency, self.delay, delay, errorRate * 100, latency, samples)
+        self.concurrency = concurrency
+        self.delay = delay
+        self.apply()
+
+    # Set the downloader and every slot, including ones it makes later, to the current values
+    def apply(self):
+        downloader = self.crawler.engine.downloader
+        # This crawl hits one site, so the global limit and the site's limit are the same
+        downloader.total_concurrency = self.concurrency
+        downloader.domain_concurrency = self.concurrency
+        if downloader.ip_concurrency:
+            downloader.ip_concurrency = self.concurrency
+        # New slots take their delay from the spider
+        self.spider.download_delay = self.delay
+        for slot in downloader.slots.values():
+            slot.concurrency = self.concurrency
+            slot.delay = self.delay
+        self.crawler.stats.set_value('throttle/concurrency', self.concurrency)
+        self.crawler.stats.set_value('throttle/delay', self.delay)
@@ -8,7 +8,14 @@
 import scrapy
 
 
-class MdCourtScraperItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+# Raw inquiry-details page HTML for a case
+class RawCaseItem(scrapy.Item):
+    case_id = scrapy.Field()
+    url = scrapy.Field()
+    html = scrapy.Field()
+    html_hash = scrapy.Field()
+
+
+# A search cell whose results pages and cases have all been crawled
+class SearchCellItem(scrapy.Item):
+    cell = scrapy.Field()
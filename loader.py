@@ -0,0 +1,185 @@
+import io
+import psycopg2
+from psycopg2.extensions import register_adapter, AsIs
+from parser import Interval
+from records import TABLE_COLS
+from profiling import stage, count
+
+# Send jail and probation terms as interval literals
+register_adapter(Interval, lambda interval: AsIs("'%s'::interval" % str(interval)))
+
+# Cases that failed to insert, kept with the error for later review
+REJECTS_TABLE = 'CREATE TABLE IF NOT EXISTS rejects (raw_case_id text, case_id text, error text, rejected_at timestamp DEFAULT now())'
+
+# Make sure the rejects table exists
+def createRejectsTable(conn):
+    cur = conn.cursor()
+    cur.execute(REJECTS_TABLE)
+    conn.commit()
+
+# Insert the parsed data for a case
+def insertParsedCase(cur, conn, raw_case_id, data):
+    # Store case ID
+    case_id = getCaseId(data)
+    if case_id is None:
+        # Delete the case if it's nonsense
+        cur.execute('DELETE FROM rawcases WHERE case_id = %s', (raw_case_id, ))
+        print('[%s] Deleted: nonsense' % raw_case_id)
+        conn.commit()
+        return
+
+    insertCaseRows(cur, raw_case_id, case_id, data)
+
+    # Commit changes to DB
+    with stage('db/commit'):
+        conn.commit()
+
+# Insert every table of a case inside a savepoint so a failure only discards this case
+def insertCaseRows(cur, raw_case_id, case_id, data):
+    cur.execute('SAVEPOINT parsed_case')
+    try:
+        insertData(cur, case_id, 'cases', data['cases'])
+        for table in data:
+            if table != 'cases':
+                insertData(cur, case_id, table, data[table])
+    # Bad values, like text with NUL characters, raise ValueError before reaching the database
+    except (psycopg2.Error, ValueError) as error:
+        cur.execute('ROLLBACK TO SAVEPOINT parsed_case')
+        rejectCase(cur, raw_case_id, case_id, error)
+        return False
+    cur.execute('RELEASE SAVEPOINT parsed_case')
+    return True
+
+# Insert data for a section/table
+def insertData(cur, case_id, table, entries):
+    # Sections can end up empty, like parties when every party was an attorney
+    if not entries:
+        return
+    rows = []
+    dataFields = TABLE_COLS[table]
+    rowTemplate = '(' + '%s, ' * (len(dataFields) - 1) + '%s)'
+    for entry in entries:
+        # Records hold the columns in order after the case ID, with the overflow map last
+        with stage('db/mogrify', table):
+            rows.append(cur.mogrify(rowTemplate, (case_id,) + entry[1:-1]).decode('utf-8'))
+    # Batch execute query
+    insertText = ','.join(rows)
+    with stage('db/insert', table):
+        cur.execute('INSERT INTO ' + table + ' ' + str(dataFields).replace('\'', '') + ' VALUES ' + insertText)
+    count('rows/' + table, len(rows))
+    print('[%s] Inserted: %s (%s)' % (case_id, table, len(rows)))
+
+# Record a case that failed to parse or insert
+def rejectCase(cur, raw_case_id, case_id, error):
+    print('[%s] Rejected: %s' % (case_id or raw_case_id, str(error).strip()))
+    cur.execute('INSERT INTO rejects (raw_case_id, case_id, error) VALUES (%s, %s, %s)', (raw_case_id, case_id, str(error).strip()))
+    # Duplicates will never insert, so drop the raw case
+    if isinstance(error, psycopg2.IntegrityError) and 'duplicate' in str(error):
+        cur.execute('DELETE FROM rawcases WHERE case_id = %s', (raw_case_id,))
+        print('[%s] Deleted: duplicate' % raw_case_id)
+
+# Delete everything parsed from some cases so they can be parsed again
+def clearParsedCases(cur, case_ids):
+    for table in TABLE_COLS:
+        if table != 'cases':
+            cur.execute('DELETE FROM ' + table + ' WHERE case_id = ANY(%s)', (case_ids,))
+    cur.execute('DELETE FROM cases WHERE case_id = ANY(%s)', (case_ids,))
+
+# Get the case ID of a parsed case, or None if it's nonsense
+def getCaseId(data):
+    try:
+        return data['cases'][0].case_id
+    except KeyError:
+        return None
+
+# Escape a value for COPY text format, dates, amounts, and intervals are written as Postgres reads them
+def copyValue(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Buffer parsed cases and load them with COPY in batches
+class BulkLoader(object):
+    def __init__(self, conn, batchSize):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.batchSize = batchSize
+        # Parsed cases in the current batch
+        self.cases = []
+        # COPY lines per table in TABLE_COLS order
+        self.buffers = {table: [] for table in TABLE_COLS}
+        # Nonsense raw cases to delete
+        self.nonsense = []
+
+    # Add a parsed case to the batch, flushing when it's full
+    def addCase(self, raw_case_id, data):
+        with stage('db/buffer'):
+            self.bufferCase(raw_case_id, data)
+        if len(self.cases) + len(self.nonsense) >= self.batchSize:
+            self.flush()
+
+    # Turn a parsed case into COPY lines, only adding them once they're all built
+    def bufferCase(self, raw_case_id, data):
+        case_id = getCaseId(data)
+        if case_id is None:
+            self.nonsense.append(raw_case_id)
+            return
+        lines = {table: [copyValue(case_id) + '\t' + '\t'.join(copyValue(value) for value in entry[1:-1]) for entry in data[table]] for table in data}
+        self.cases.append((raw_case_id, data))
+        for table in lines:
+            self.buffers[table].extend(lines[table])
+
+    # Load and commit everything buffered so far
+    # The batch is always cleared, so a failure can't make every later flush fail too
+    def flush(self):
+        try:
+            try:
+                self.copyBatch()
+            except (psycopg2.IntegrityError, psycopg2.DataError) as error:
+                self.conn.rollback()
+                print('Error copying batch, inserting cases one by one: %s' % str(error).strip())
+                self.insertBatch()
+        except Exception as error:
+            # Nothing points at one case, so reject the whole batch
+            # If the connection is gone the rollback raises and stops the worker
+            self.conn.rollback()
+            print('Error loading batch, rejecting %s cases: %s' % (len(self.cases), str(error).strip()))
+            for raw_case_id, data in self.cases:
+                rejectCase(self.cur, raw_case_id, getCaseId(data), error)
+            self.conn.commit()
+        finally:
+            self.cases = []
+            self.buffers = {table: [] for table in TABLE_COLS}
+            self.nonsense = []
+
+    # Load the batch with one COPY per table and one commit
+    def copyBatch(self):
+        self.deleteNonsense()
+        for table, lines in self.buffers.items():
+            if lines:
+                count('rows/' + table, len(lines))
+                with stage('db/copy', table):
+                    self.cur.copy_expert('COPY ' + table + ' ' + str(TABLE_COLS[table]).replace('\'', '') + ' FROM STDIN', io.StringIO('\n'.join(lines) + '\n'))
+        with stage('db/commit'):
+            self.conn.commit()
+        print('Copied: %s cases' % len(self.cases))
+
+    # Redo the batch one savepoint per case so only the bad cases are rejected
+    def insertBatch(self):
+        self.deleteNonsense()
+        rejected = 0
+        for raw_case_id, data in self.cases:
+            if not insertCaseRows(self.cur, raw_case_id, getCaseId(data), data):
+                rejected += 1
+        self.conn.commit()
+        print('Inserted: %s cases, rejected %s' % (len(self.cases) - rejected, rejected))
+
+    # Delete the raw cases in the batch that parsed to nothing
+    def deleteNonsense(self):
+        if self.nonsense:
+            self.cur.execute('DELETE FROM rawcases WHERE case_id = ANY(%s)', (self.nonsense,))
+            print('Deleted: %s nonsense' % len(self.nonsense))
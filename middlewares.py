@@ -5,52 +5,277 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import json
+import os
+import random
+import time
+import psycopg2
+from twisted.internet import task, reactor
+from twisted.internet.error import TimeoutError, DNSLookupError, ConnectionRefusedError, ConnectionDone, ConnectError, ConnectionLost, TCPTimedOutError
+from twisted.web.client import ResponseFailed
 from scrapy import signals
+from scrapy.exceptions import NotConfigured, IgnoreRequest, DontCloseSpider
+from md_court_scraper.items import RawCaseItem
 
+# Latency quantiles reported per callback
+QUANTILES = (0.5, 0.9, 0.99)
 
-class MdCourtScraperSpiderMiddleware(object):
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+# Download errors worth trying again
+RETRY_EXCEPTIONS = (TimeoutError, DNSLookupError, ConnectionRefusedError, ConnectionDone, ConnectError, ConnectionLost, TCPTimedOutError, ResponseFailed, IOError)
+
+# Requests that failed for good, kept so they can be looked at or crawled again
+DEAD_LETTERS_TABLE = 'CREATE TABLE IF NOT EXISTS dead_letters (url text, method text, body text, cell text, status integer, reason text, attempts integer, failed_at timestamp DEFAULT now())'
+
+# Get a quantile of a list of values by nearest rank
+def quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Track where crawl time goes and export it every METRICS_INTERVAL seconds
+# METRICS_FORMAT = 'jsonl' appends a line per export to METRICS_FILE,
+# 'prometheus' rewrites it for the node exporter's textfile collector
+class CrawlMetricsMiddleware(object):
+    def __init__(self, crawler, path, format, interval):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.path = path
+        self.format = format
+        self.interval = interval
+        # Callback name -> [calls, total seconds, max seconds, latencies since the last export]
+        self.callbacks = {}
+        self.savedCases = 0
+        self.downloadTime = 0.0
+        self.timer = None
+        self.lastTime = None
+        self.lastPages = 0
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
+        path = crawler.settings.get('METRICS_FILE')
+        if not path:
+            raise NotConfigured
+        metrics = cls(crawler, path, crawler.settings.get('METRICS_FORMAT', 'jsonl'), crawler.settings.getfloat('METRICS_INTERVAL', 10))
+        crawler.signals.connect(metrics.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(metrics.spider_closed, signal=signals.spider_closed)
+        return metrics
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    def spider_opened(self, spider):
+        self.lastTime = time.time()
+        self.timer = task.LoopingCall(self.export)
+        self.timer.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.timer and self.timer.running:
+            self.timer.stop()
+        self.export()
 
-        # Should return None or raise an exception.
+    # Count the time spent downloading and note when the response was handed to the spider
+    # The request is left alone, since the spider may yield copies of it
+    def process_spider_input(self, response, spider):
+        self.downloadTime += response.meta.get('download_latency', 0)
+        response.meta['metrics_start'] = time.time()
         return None
 
+    # Time the callback from when the spider got the response, so this includes Scrapy's short wait before
+    # calling it and any DB lookup it returns, then add the time spent producing each entry but not the time entries wait to be used
     def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+        callback = response.request.callback
+        elapsed = time.time() - response.meta.pop('metrics_start', time.time())
+        entries = iter(result)
+        while True:
+            step = time.time()
+            try:
+                entry = next(entries)
+            except StopIteration:
+                break
+            elapsed += time.time() - step
+            if isinstance(entry, RawCaseItem):
+                self.savedCases += 1
+            yield entry
+        elapsed += time.time() - step
+        if callback is not None:
+            stats = self.callbacks.setdefault(getattr(callback, '__name__', 'parse'), [0, 0.0, 0.0, []])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3].append(elapsed)
+
+    # Get the current metrics, clearing the latencies collected since the last call
+    def snapshot(self):
+        now = time.time()
+        stats = self.stats.get_stats()
+        pages = stats.get('response_received_count', 0)
+        requests = stats.get('downloader/request_count', 0)
+        try:
+            pendingRequests = len(self.crawler.engine.slot.scheduler)
+        except AttributeError:
+            pendingRequests = 0
+        callbacks = {}
+        for name, (calls, total, longest, latencies) in self.callbacks.items():
+            callbacks[name] = {'calls': calls, 'seconds': total, 'max': longest}
+            for q in QUANTILES:
+                callbacks[name]['p%g' % (q * 100)] = quantile(latencies, q) if latencies else None
+            del latencies[:]
+        data = {
+            'time': now,
+            'pages': pages,
+            'pages_per_sec': (pages - self.lastPages) / (now - self.lastTime) if now > self.lastTime else 0.0,
+            'requests': requests,
+            'saved_cases': self.savedCases,
+            'requests_per_saved_case': requests / self.savedCases if self.savedCases else None,
+            'retries': stats.get('retry/count', 0),
+            'pending_requests': pendingRequests,
+            'download_seconds': self.downloadTime,
+            'db_insert_seconds': stats.get('db/insert_seconds', 0.0),
+            'db_lookup_seconds': stats.get('db/lookup_seconds', 0.0),
+            'callbacks': callbacks
+        }
+        self.lastTime = now
+        self.lastPages = pages
+        return data
+
+    def export(self):
+        data = self.snapshot()
+        if self.format == 'prometheus':
+            # Write a new file and swap it in so the collector never reads half of one
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(prometheusText(data))
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(data) + '\n')
 
-        # Must return an iterable of Request, dict or Item objects.
-        for i in result:
-            yield i
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+# Format a metrics snapshot in the Prometheus text exposition format
+def prometheusText(data):
+    lines = []
+    def metric(name, kind, value, labels=''):
+        # Samples of a metric already declared leave the type out
+        if kind:
+            lines.append('# TYPE mdcourt_%s %s' % (name, kind))
+        if value is not None:
+            lines.append('mdcourt_%s%s %s' % (name, labels, repr(float(value))))
+    metric('pages_total', 'counter', data['pages'])
+    metric('pages_per_second', 'gauge', data['pages_per_sec'])
+    metric('requests_total', 'counter', data['requests'])
+    metric('saved_cases_total', 'counter', data['saved_cases'])
+    metric('requests_per_saved_case', 'gauge', data['requests_per_saved_case'])
+    metric('retries_total', 'counter', data['retries'])
+    metric('pending_requests', 'gauge', data['pending_requests'])
+    metric('download_seconds_total', 'counter', data['download_seconds'])
+    metric('db_seconds_total', 'counter', data['db_insert_seconds'], '{stage="insert"}')
+    metric('db_seconds_total', None, data['db_lookup_seconds'], '{stage="lookup"}')
+    kind = 'summary'
+    for name, stats in data['callbacks'].items():
+        for q in QUANTILES:
+            metric('callback_seconds', kind, stats['p%g' % (q * 100)], '{callback="%s",quantile="%g"}' % (name, q))
+            kind = None
+        metric('callback_seconds_sum', None, stats['seconds'], '{callback="%s"}' % name)
+        metric('callback_seconds_count', None, stats['calls'], '{callback="%s"}' % name)
+    return '\n'.join(lines) + '\n'
 
-        # Should return either None or an iterable of Response, dict
-        # or Item objects.
-        pass
 
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
+# Retry failed downloads a bounded number of times, waiting longer after each attempt
+# Retries wait outside the downloader and go back through the scheduler, so they don't hold a slot
+# Other error statuses and requests out of attempts go to the dead_letters table
+class BackoffRetryMiddleware(object):
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('RETRY_ENABLED', True):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.maxRetries = settings.getint('RETRY_TIMES', 2)
+        self.retryCodes = set(int(code) for code in settings.getlist('RETRY_HTTP_CODES'))
+        self.backoffBase = settings.getfloat('RETRY_BACKOFF_BASE', 1)
+        self.backoffMax = settings.getfloat('RETRY_BACKOFF_MAX', 60)
+        # Shortest wait per status, e.g. to back off further when throttled
+        self.statusDelays = {int(code): float(delay) for code, delay in settings.getdict('RETRY_STATUS_DELAYS').items()}
+        # Retries waiting to be scheduled
+        self.delayed = set()
+        self.dbpool = None
 
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
+    @classmethod
+    def from_crawler(cls, crawler):
+        retry = cls(crawler)
+        crawler.signals.connect(retry.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(retry.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(retry.spider_closed, signal=signals.spider_closed)
+        return retry
 
     def spider_opened(self, spider):
-        spider.logger.info('Spider opened: %s' % spider.name)
+        self.dbpool = getattr(spider, 'dbpool', None)
+        if self.dbpool is not None:
+            return self.dbpool.runInteraction(self.createTable)
+
+    # Make sure the dead letter table exists, run inside the DB thread
+    def createTable(self, cur):
+        try:
+            cur.execute(DEAD_LETTERS_TABLE)
+        except psycopg2.IntegrityError:
+            # Another shard created it at the same time
+            cur.connection.rollback()
+
+    # Keep the spider open while retries are waiting
+    def spider_idle(self, spider):
+        if self.delayed:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider, reason):
+        for call in self.delayed:
+            if call.active():
+                call.cancel()
+        if self.delayed:
+            spider.logger.warning('Dropped %s retries still waiting at close', len(self.delayed))
+        self.delayed.clear()
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 or request.meta.get('dont_retry'):
+            return response
+        if response.status in self.retryCodes:
+            self.retry(request, response.status, 'status %s' % response.status, spider, response.headers.get('Retry-After'))
+        elif response.status >= 400:
+            self.deadLetter(request, response.status, 'status %s' % response.status, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, RETRY_EXCEPTIONS) and not request.meta.get('dont_retry'):
+            self.retry(request, None, exception.__class__.__name__, spider)
+
+    # Schedule another attempt after a backoff, or give up once attempts run out
+    def retry(self, request, status, reason, spider, retryAfter=None):
+        retries = request.meta.get('retry_times', 0) + 1
+        if retries > self.maxRetries:
+            self.stats.inc_value('retry/max_reached')
+            self.deadLetter(request, status, reason, spider)
+            return
+        # Exponential backoff with full jitter, but never sooner than the status or server asks
+        delay = random.uniform(0, min(self.backoffMax, self.backoffBase * 2 ** (retries - 1)))
+        delay = max(delay, self.statusDelays.get(status, 0))
+        if retryAfter and retryAfter.isdigit():
+            delay = max(delay, min(self.backoffMax, float(retryAfter)))
+        retryRequest = request.replace(dont_filter=True)
+        retryRequest.meta['retry_times'] = retries
+        self.stats.inc_value('retry/count')
+        self.stats.inc_value('retry/reason_count/%s' % reason)
+        spider.logger.debug('Retrying %s in %.1fs (attempt %s, %s)', request.url, delay, retries + 1, reason)
+        call = reactor.callLater(delay, self.schedule, retryRequest)
+        self.delayed.add(call)
+        # Drop this attempt so the spider only sees the final response
+        raise IgnoreRequest('Retrying %s' % reason)
+
+    def schedule(self, request):
+        self.delayed = {call for call in self.delayed if call.active()}
+        self.crawler.engine.crawl(request)
+
+    # Record a request that won't be tried again
+    def deadLetter(self, request, status, reason, spider):
+        attempts = request.meta.get('retry_times', 0) + 1
+        self.stats.inc_value('retry/dead_letters')
+        spider.logger.error('Giving up on %s after %s attempts (%s)', request.url, attempts, reason)
+        if self.dbpool is None:
+            return
+        body = request.body.decode('utf-8', 'replace') if request.body else None
+        d = self.dbpool.runOperation('INSERT INTO dead_letters (url, method, body, cell, status, reason, attempts) VALUES (%s, %s, %s, %s, %s, %s, %s)', (request.url, request.method, body, request.meta.get('cell'), status, reason, attempts))
+        d.addErrback(lambda failure: spider.logger.error('Failed to record dead letter for %s: %s', request.url, failure.getErrorMessage()))
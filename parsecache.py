@@ -0,0 +1,102 @@
+import json
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import Counter
+from parser import caseRows, formatSections, countDrift, ROWS_VERSION, FORMAT_VERSION
+from attrnames import ATTRIBUTE_MAP, HEADER_MAP
+from records import TABLE_COLS
+from profiling import stage
+
+# Section lists only depend on the row stage, parsed cases depend on both stages, the label maps, and the table columns
+ROWS_KEY = str(ROWS_VERSION)
+DATA_KEY = '%s.%s.%s' % (ROWS_VERSION, FORMAT_VERSION, hashlib.sha256(repr((ATTRIBUTE_MAP, HEADER_MAP, TABLE_COLS)).encode('utf-8')).hexdigest()[:12])
+
+ROWS_TABLE = 'CREATE TABLE IF NOT EXISTS case_rows (html_hash text, version text, rows text, PRIMARY KEY (html_hash, version))'
+# Parsed cases hold records, dates, amounts, and intervals, so they're pickled rather than JSON
+DATA_TABLE = 'CREATE TABLE IF NOT EXISTS case_data (html_hash text, version text, data blob, PRIMARY KEY (html_hash, version))'
+
+# Lookups by every ParseCache in this process, as 'hits' for parsed cases, 'row hits' for cases only the rows were cached for, and 'misses'
+lookups = Counter()
+lock = threading.Lock()
+
+# Get the key a page is cached under
+# This is the exact HTML rather than rawhtml.contentHash, which ignores changes that can reach the parser
+def htmlHash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+# Local cache of parse results, so reparsing only reruns the stages that changed
+# Opens its own SQLite connection, so use one per thread or process
+class ParseCache(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        # Let parser processes read while another one writes, and don't sync every insert
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(ROWS_TABLE)
+        self.conn.execute(DATA_TABLE)
+        self.conn.commit()
+
+    # Parse a case, skipping whatever is already cached for this version
+    def parse(self, html, backend='bs4'):
+        key = htmlHash(html)
+        row = self.conn.execute('SELECT data FROM case_data WHERE html_hash = ? AND version = ?', (key, DATA_KEY)).fetchone()
+        if row:
+            countLookup('hits')
+            data, dropped = pickle.loads(row[0])
+            countDrift(data, dropped)
+            return data
+
+        # Only rerun the mapping stage if the rows are cached
+        row = self.conn.execute('SELECT rows FROM case_rows WHERE html_hash = ? AND version = ?', (key, ROWS_KEY)).fetchone()
+        if row:
+            countLookup('row hits')
+            rows = json.loads(row[0])
+        else:
+            countLookup('misses')
+            rows = caseRows(html, backend)
+            # Keep the rows so a mapping change only reruns formatSections
+            self.conn.execute('INSERT OR REPLACE INTO case_rows (html_hash, version, rows) VALUES (?, ?, ?)', (key, ROWS_KEY, json.dumps(rows)))
+
+        with stage('format/output'):
+            data, dropped = formatSections(rows)
+        countDrift(data, dropped)
+        # Keep what was dropped so cached cases still show up in the drift report
+        self.conn.execute('INSERT OR REPLACE INTO case_data (html_hash, version, data) VALUES (?, ?, ?)', (key, DATA_KEY, pickle.dumps((data, dropped), pickle.HIGHEST_PROTOCOL)))
+        self.conn.commit()
+        return data
+
+    # Delete results from other parser versions and return how many of each were removed
+    def evict(self):
+        rows = self.conn.execute('DELETE FROM case_rows WHERE version != ?', (ROWS_KEY,)).rowcount
+        data = self.conn.execute('DELETE FROM case_data WHERE version != ?', (DATA_KEY,)).rowcount
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+        return rows, data
+
+    def close(self):
+        self.conn.close()
+
+# Count a lookup
+def countLookup(kind):
+    with lock:
+        lookups[kind] += 1
+
+# Get and clear this process's lookup counts
+def takeCacheStats():
+    global lookups
+    with lock:
+        taken = lookups
+        lookups = Counter()
+    return taken
+
+# Add lookup counts taken from a parser process
+def mergeCacheStats(taken):
+    with lock:
+        lookups.update(taken)
+
+# Print how often the cache saved each stage
+def reportCacheStats():
+    total = sum(lookups.values())
+    print('Parse cache: %s hits, %s row hits, %s misses (%.1f%% of cases not reparsed)' % (lookups['hits'], lookups['row hits'], lookups['misses'], (total - lookups['misses']) * 100.0 / total if total else 0))
@@ -1,29 +1,209 @@
+import re
 from bs4 import BeautifulSoup
-from attrnames import getAttributeName, getSectionName
+from bs4.builder._htmlparser import BeautifulSoupHTMLParser
+from bs4.dammit import EntitySubstitution
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from html.parser import HTMLParser
+from attrnames import ATTRIBUTE_MAP, HEADER_MAP, getAttributeName, getSectionName
+from profiling import stage
+import drift
+from records import RECORDS, COLUMN_INDEX, makeRecord, recordDict
 
-def parseCase(html):
-	# Import into BS
-	soup = BeautifulSoup(html, 'html.parser')
+# Tags holding KVPs, headers, and separators
+ROW_TAGS = ('span', 'h5', 'h6', 'i', 'hr')
+# Tags BS closes as soon as they're opened
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'}
+# Tags whose contents BS leaves out of get_text(), including tags nested in them
+SCRIPT_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+# Tags BS keeps whitespace-only strings intact in
+PRESERVE_TAGS = {'pre', 'textarea'}
+# Whitespace BS collapses in whitespace-only strings
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
 
+# Bump when a change alters the section list caseRows builds, or what formatOutput makes of it
+ROWS_VERSION = 2
+FORMAT_VERSION = 6
+
+# Jail and probation term fields, split into years, months, days, and hours on the page
+INTERVAL_LABELS = {'Jail Term', 'Suspended Term', 'UnSuspended Term', 'Probation', 'Supervised', 'UnSupervised'}
+# Terms as collected by buildSections
+INTERVAL_TEXT = re.compile(r'^(\d+)-(\d+) (\d+) (\d+):00:00$')
+
+# Flat page row consumed by parseCase
+Row = namedtuple('Row', ['name', 'classes', 'parent', 'text'])
+
+# Jail and probation terms, which have months so can't be timedeltas
+class Interval(namedtuple('Interval', ['years', 'months', 'days', 'hours'])):
+	__slots__ = ()
+
+	# Postgres interval input
+	def __str__(self):
+		return '%s years %s mons %s days %s hours' % self
+
+# Get page rows by building a full BS tree
+def soupRows(html):
+	with stage('parse/soup'):
+		soup = BeautifulSoup(html, 'html.parser')
+	with stage('parse/find_all'):
+		found = soup.find_all(ROW_TAGS)
+	return [Row(row.name, row.attrs.get('class', []), row.parent.name, row.get_text()) for row in found]
+
+# Get page rows in a single pass without building a tree
+def streamRows(html):
+	tokenizer = RowTokenizer()
+	tokenizer.feed(html)
+	tokenizer.close()
+	return [Row(name, classes, parent, ''.join(text)) for name, classes, parent, text in tokenizer.rows]
+
+# Row sources selectable in parseCase
+BACKENDS = {
+	'bs4': soupRows,
+	'stream': streamRows
+}
+
+# Event-based tokenizer mirroring how BS nests tags with html.parser
+# References are resolved the way BS does it rather than by html.unescape, which also expands legacy
+# entities missing their semicolon, like the &LT in SMITH&LTD
+class RowTokenizer(HTMLParser):
+	def __init__(self):
+		HTMLParser.__init__(self, convert_charrefs=False)
+		# Rows as (name, classes, parent, text parts)
+		self.rows = []
+		# Open tags as (name, text parts or None)
+		self.stack = []
+		# Text parts of open rows
+		self.openText = []
+		# Void tags whose end tag should be ignored
+		self.closedVoids = []
+		# Text not yet assigned to the open rows
+		self.pending = []
+
+	def handle_starttag(self, tag, attrs, closeVoid=True):
+		self.flushData()
+		parent = self.stack[-1][0] if self.stack else '[document]'
+		text = None
+		if tag in ROW_TAGS:
+			# Last class attribute wins, same as BS
+			classes = []
+			for name, value in attrs:
+				if name == 'class':
+					classes = (value or '').split()
+			text = []
+			self.rows.append((tag, classes, parent, text))
+			self.openText.append(text)
+		self.stack.append((tag, text))
+		# Close void tags right away
+		if closeVoid and tag in VOID_TAGS:
+			self.popTo(len(self.stack) - 1)
+			self.closedVoids.append(tag)
+
+	def handle_startendtag(self, tag, attrs):
+		self.handle_starttag(tag, attrs, closeVoid=False)
+		self.handle_endtag(tag, checkClosed=False)
+
+	def handle_endtag(self, tag, checkClosed=True):
+		if checkClosed and tag in self.closedVoids:
+			self.closedVoids.remove(tag)
+			return
+		self.flushData()
+		# Pop back to the most recent matching tag, ignore strays
+		for i in range(len(self.stack) - 1, -1, -1):
+			if self.stack[i][0] == tag:
+				self.popTo(i)
+				break
+
+	def handle_data(self, data):
+		self.pending.append(data)
+
+	# Same as BeautifulSoupHTMLParser.handle_charref
+	def handle_charref(self, name):
+		dereferenced, replacementAdded, extraData = BeautifulSoupHTMLParser._dereference_numeric_character_reference(name)
+		if dereferenced is not None:
+			self.pending.append(dereferenced)
+		if extraData is not None:
+			self.pending.append(extraData)
+
+	# Same as BeautifulSoupHTMLParser.handle_entityref, unknown entities are kept as text
+	def handle_entityref(self, name):
+		character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+		self.pending.append(character if character is not None else '&%s' % name)
+
+	def handle_comment(self, data):
+		self.flushData()
+
+	def handle_decl(self, decl):
+		self.flushData()
+
+	def handle_pi(self, data):
+		self.flushData()
+
+	# BS keeps CDATA sections as their own strings, which get_text() includes
+	def unknown_decl(self, data):
+		self.flushData()
+		if data.upper().startswith('CDATA['):
+			self.pending.append(data[len('CDATA['):])
+			self.flushData()
+
+	def close(self):
+		HTMLParser.close(self)
+		self.flushData()
+
+	# Add buffered text to every open row, the same way BS ends a string
+	def flushData(self):
+		if not self.pending:
+			return
+		data = ''.join(self.pending)
+		self.pending = []
+		if any(tag in SCRIPT_TAGS for tag, text in self.stack):
+			return
+		# Collapse whitespace-only strings
+		if not data.strip(ASCII_SPACES) and not any(tag in PRESERVE_TAGS for tag, text in self.stack):
+			data = '\n' if '\n' in data else ' '
+		for text in self.openText:
+			text.append(data)
+
+	# Close every open tag from index onwards
+	def popTo(self, index):
+		rowCount = sum(1 for tag, text in self.stack[index:] if text is not None)
+		if rowCount:
+			del self.openText[-rowCount:]
+		del self.stack[index:]
+
+def parseCase(html, backend='bs4'):
+	rows = caseRows(html, backend)
+	with stage('format/output'):
+		return formatOutput(rows)
+
+# Get the list of section headers and KVP dicts on a page
+def caseRows(html, backend='bs4'):
+	# Get KVPs, headers, and separators
+	with stage('parse/rows'):
+		rows = BACKENDS[backend](html)
+	with stage('parse/state_machine'):
+		return buildSections(rows)
+
+# Walk page rows, collecting section headers and KVP dicts
+def buildSections(rows):
 	# Temporary KVP store
 	data = {}
 	# Full data list
 	output = []
 
-	# Get KVPs, headers, and separators
-	rows = soup.find_all(['span', 'h5', 'h6', 'i', 'hr'])
 	# Iterate thru page rows
 	i = 0
 	while i < len(rows):
 		row = rows[i]
 
 		# Save class list
-		classes = row.attrs.get('class', [])
+		classes = row.classes
 
 		if 'AltBodyWindowDcCivil' not in classes:
 			# Field names
 			if 'FirstColumnPrompt' in classes or 'Prompt' in classes:
-				headerval = row.get_text()
+				headerval = row.text
 
 				# Remove unnecessary end chars
 				if headerval.endswith(':'): headerval = headerval[:-1]
@@ -32,23 +212,23 @@ def parseCase(html):
 				headerval = stripWhitespace(headerval)
 
 				# Parse newer charge statue code format
-				if headerval == 'Article' and stripWhitespace(rows[i+2].get_text()) == 'Sec:':
+				if headerval == 'Article' and stripWhitespace(rows[i+2].text) == 'Sec:':
 					# Build statute code from individual fields
 					statuteCode = []
 					for j in range(i+1, i+10, 2):
-						if 'Value' in rows[j].attrs.get('class', []):
-							statuteCode.append(stripWhitespace(rows[j].get_text()))
+						if 'Value' in rows[j].classes:
+							statuteCode.append(stripWhitespace(rows[j].text))
 					# Append as KVP
 					data['Statute Code'] = '.'.join(filter(None, statuteCode))
 					# Skip to the next section after this
 					i += 10
 				# Parse jail and probation terms
-				elif headerval in {'Jail Term', 'Suspended Term', 'UnSuspended Term', 'Probation', 'Supervised', 'UnSupervised'}:
+				elif headerval in INTERVAL_LABELS:
 					# Generate interval string from yrs+mos+days+hrs fields
-					yrs = stripWhitespace(rows[i+2].get_text()) or '0'
-					mos = stripWhitespace(rows[i+4].get_text()) or '0'
-					days = stripWhitespace(rows[i+6].get_text()) or '0'
-					hrs = stripWhitespace(rows[i+8].get_text()) or '0'
+					yrs = stripWhitespace(rows[i+2].text) or '0'
+					mos = stripWhitespace(rows[i+4].text) or '0'
+					days = stripWhitespace(rows[i+6].text) or '0'
+					hrs = stripWhitespace(rows[i+8].text) or '0'
 					# Cleanup intervals
 					if yrs.isdigit() and mos.isdigit():
 						iyrs = int(yrs)
@@ -64,38 +244,38 @@ def parseCase(html):
 					# Skip to the next section after this
 					i += 8
 				# Parse newer event table format
-				elif row.parent.name == 'th' and headerval == 'Event Type':
+				elif row.parent == 'th' and headerval == 'Event Type':
 					# Get number of table columns
 					headerVals = []
 					for j in range(i, len(rows)):
-						if rows[j].parent.name != 'th':
+						if rows[j].parent != 'th':
 							break
 						else:
-							headerVals.append(stripWhitespace(rows[j].get_text()))
+							headerVals.append(stripWhitespace(rows[j].text))
 					# Get row values
 					rowVals = []
 					for k in range(i+len(headerVals), len(rows)):
-						if not 'Value' in rows[k].attrs.get('class', []):
+						if not 'Value' in rows[k].classes:
 							i = k # Skip to the next section after this
 							break
 						else:
-							rowVals.append(stripWhitespace(rows[k].get_text()))
+							rowVals.append(stripWhitespace(rows[k].text))
 					# Split and append events
 					for l in range(0, len(rowVals), len(headerVals)):
 						eventData = {x[0]: x[1] for x in zip(headerVals, rowVals[l:l+len(headerVals)])}
 						output.append(eventData)
 			# Values
 			elif 'Value' in classes:
-				dataval = stripWhitespace(row.get_text())
+				dataval = stripWhitespace(row.text)
 				if headerval and dataval != 'MONEY JUDGMENT': # The 'money judgement' header is useless
 					data[headerval] = dataval
 			# Headers and separators
 			else:
 				if 'InfoChargeStatement' not in classes:
 					if row.name in {'hr', 'h5', 'h6', 'i'}:
-						header = stripWhitespace(row.get_text())
+						header = stripWhitespace(row.text)
 						# Skip over the charge subheadings
-						if not (header in {'Disposition', 'Jail', 'Probation', 'Fine', 'Community Work Service'} and row.name == 'i' and row.parent.name == 'left'):
+						if not (header in {'Disposition', 'Jail', 'Probation', 'Fine', 'Community Work Service'} and row.name == 'i' and row.parent == 'left'):
 							# Append the KVPs and reset the temporary dict
 							if data:
 								output.append(data)
@@ -113,103 +293,243 @@ def parseCase(html):
 		output.append(data)
 		data = {}
 
-	return formatOutput(output)
+	return output
+
+# Attributes stored as booleans
+BOOLEAN_ATTRS = {'probable_cause', 'accident_contribution', 'property_damage', 'seatbelts_used', 'mandatory_court_appearance'}
+
+# Convert heights in feet and inches to inches
+def formatHeight(value):
+	if '\'' in value or '"' in value:
+		vals = value.replace('"', '\'').split('\'')
+		return int(vals[0] or 0) * 12 + int(vals[1] or 0)
+	return int(value)
+
+def formatSex(value):
+	return value.upper()[0]
+
+# Parse month/day/year dates, filling in the day of month/year ones
+# The same dates come up over and over, so they're only parsed once
+@lru_cache(maxsize=65536)
+def formatDate(value):
+	vals = value.split('/')
+	if len(vals) == 2:
+		vals.insert(1, '1')
+	if len(vals) != 3:
+		raise ValueError('not a date')
+	year = int(vals[2])
+	# Two digit years the way Postgres reads them
+	if len(vals[2]) <= 2:
+		year += 2000 if year < 70 else 1900
+	return date(year, int(vals[0]), int(vals[1]))
+
+def formatBool(value):
+	return value.lower() in {'y', 'yes'}
+
+# Leave traffic accident injuries empty unless there's a number
+def formatInjuries(value):
+	return int(value) if value.isdigit() else None
+
+# Parse dollar amounts
+def formatMoney(value):
+	try:
+		return Decimal(value.replace('$', '').replace(',', ''))
+	except InvalidOperation:
+		raise ValueError('not an amount')
+
+def formatInterval(value):
+	match = INTERVAL_TEXT.match(value)
+	if not match:
+		raise ValueError('not a term')
+	return Interval(*(int(part) for part in match.groups()))
+
+# Get the attribute name and converter for a field label
+def planAttribute(label):
+	name = getAttributeName(label)
+	if label in INTERVAL_LABELS:
+		converter = formatInterval
+	elif name == 'height':
+		converter = formatHeight
+	elif name == 'sex':
+		converter = formatSex
+	elif 'date' in name or name == 'dob':
+		converter = formatDate
+	elif name in BOOLEAN_ATTRS:
+		converter = formatBool
+	elif name == 'injuries':
+		converter = formatInjuries
+	elif name in {'amt', 'interest'} or name.endswith('_amt'):
+		converter = formatMoney
+	else:
+		converter = None
+	ATTRIBUTE_PLANS[label] = (name, converter)
+	return name, converter
+
+# Get the table a section goes in, with the type given to attorneys or parties in it
+def planSection(title):
+	table = getSectionName(title)
+	attorneyType = None
+	partyType = None
+	if table:
+		# Attorneys get a type based on what section they're in
+		if title.startswith('Attorney(s) for the '):
+			attorneyType = title[20:]
+		# Officers get a type to indicate that they're officers
+		elif table == 'parties' and ('Surety' in title or 'Bond' in title or 'Defendant' in title or 'Plaintiff' in title or 'Officer' in title):
+			partyType = title.replace(' Information', '')
+	SECTION_PLANS[title] = (table, attorneyType, partyType)
+	return SECTION_PLANS[title]
+
+# Where parties records keep the party type
+PARTY_TYPE = COLUMN_INDEX['parties']['type']
+
+# Plans for every known label and section, others are added the first time they're seen
+ATTRIBUTE_PLANS = {}
+SECTION_PLANS = {}
+for label in ATTRIBUTE_MAP:
+	planAttribute(label)
+for title in HEADER_MAP:
+	planSection(title)
 
 def formatOutput(data):
+	output, dropped = formatSections(data)
+	countDrift(output, dropped)
+	return output
+
+# Get the layout a parsed case is reported under, the court system's type after ' - ' like decisiontreejson.py splits it
+# e.g. 'District Court for Baltimore City - Criminal System' is 'Criminal System'
+def getLayout(output):
+	cases = output.get('cases')
+	courtSystem = cases and cases[0].court_system
+	if not courtSystem:
+		return 'unknown'
+	return courtSystem.rsplit(' - ', 1)[-1].strip()
+
+# Count what was dropped from a case under its layout
+def countDrift(output, dropped):
+	if dropped:
+		drift.add(getLayout(output), dropped)
+
+# Turn the section list into records per table, along with the sections and fields that won't be stored
+def formatSections(data):
 	# Final output dict
 	output = {}
+	# Parties that are attorneys for another party, added to attorneys at the end
+	movedAttorneys = []
+	# Sections and fields that won't be stored
+	dropped = []
 
-	# Add case information header if necessary
-	if len(data) > 0 and not isinstance(data[0], str):
-		data.insert(0, 'Case Information')
-
+	# Anything before the first header is case information
+	section = SECTION_PLANS['Case Information']
 	# Iterate thru data list
-	for i in range(len(data)):
+	for item in data:
 		# Check if item is a section header
-		if isinstance(data[i], str):
-			# Get proper attribute name
-			header = getSectionName(data[i])
-			# Make sure section is going to be stored
-			if header:
-				entries = []
-				# Find KVP dicts corresponding to this header
-				for j in range(i+1, len(data)):
-					# Stop looking when we reach a different header
-					if isinstance(data[j], str):`																																												`
-						break
-					# Get proper attribute names for fields
-					attrMap = formatAttrs(data[j], data[i], header)
-					# Save this dict if it hasn't been nullified
-					if attrMap:
-						entries.append(attrMap)
-				# Add all the data we found to the master dict
-				if output.get(header):
-					output[header] += entries
-				elif entries:
-					output[header] = entries
-
-	# Move attorneys listed under parties to attorneys
-	parties = output.get('parties', [])
-	j = 0
-	while j < len(parties):
-		partyType = parties[j].get('type')
-		# Check if party type is an attorney
-		if partyType and partyType.lower().startswith('attorney for '):
-			# Remove the party from the parties list
-			party = parties.pop(j)
-			j -= 1
-			# Set the type to the appropriate attorney type
-			party['type'] = partyType[13:]
-			# Create attorneys key if necessary
-			if not output.get('attorneys'):
-				output['attorneys'] = []
-			# Append this attorney
-			output['attorneys'].append(party)
-		j += 1
+		if isinstance(item, str):
+			section = SECTION_PLANS.get(item) or planSection(item)
+			if not section[0]:
+				dropped.append(('section', None, item))
+			continue
+		table = section[0]
+		# Make sure section is going to be stored
+		if not table:
+			continue
+		# Get proper attribute names for fields
+		with stage('format/attrs'):
+			record = formatAttrs(item, section, dropped)
+		# Skip this record if it's been discarded
+		if record is None:
+			continue
+		# Move attorneys listed under parties to attorneys
+		if table == 'parties':
+			partyType = record[PARTY_TYPE]
+			if partyType and partyType.lower().startswith('attorney for '):
+				# Set the type to the appropriate attorney type
+				fields = recordDict(record, table)
+				fields['type'] = partyType[13:]
+				movedAttorneys.append(makeRecord('attorneys', fields))
+				# Parties stays in the output even if all of them were attorneys
+				output.setdefault(table, [])
+				continue
+		output.setdefault(table, []).append(record)
 
-	return output
+	if movedAttorneys:
+		output.setdefault('attorneys', []).extend(movedAttorneys)
+
+	return output, dropped
 
-def formatAttrs(data, section, header):
-	# Formatted output dict
-	d = {}
+# Turn a KVP dict into a record for the section's table, adding fields it has no column for and values it can't convert to dropped
+def formatAttrs(data, section, dropped):
+	table, attorneyType, partyType = section
+	index = COLUMN_INDEX[table]
+	droppedBefore = len(dropped)
+	# Record values in column order, then the overflow map
+	values = [None] * len(index)
+	overflow = None
+	# Whether the page had an appearance date, before conversion can blank it
+	appeared = False
 
 	# Iterate thru fields in input dict
-	for field in data:
-		# Get proper field names
-		formattedName = getAttributeName(field)
-		d[formattedName] = data[field]
-		if data[field]:
-			# Format heights
-			if formattedName == 'height' and ('\'' in data[field] or '"' in data[field]):
-				vals = data[field].replace('"', '\'').split('\'')
-				d[formattedName] = str(int(vals[0] or 0) * 12 + int(vals[1] or 0))
-			# Format sex
-			elif formattedName == 'sex':
-				d[formattedName] = data[field].upper()[0]
-			# Format dates
-			elif ('date' in formattedName or formattedName == 'dob'):
-				vals = data[field].split('/')
-				if len(vals) < 3:
-					d[formattedName] = vals[0] + '/01/' + vals[1]
-			# Format booleans
-			elif formattedName in {'probable_cause', 'accident_contribution', 'property_damage', 'seatbelts_used', 'mandatory_court_appearance'}:
-				d[formattedName] = data[field].lower() in {'y', 'yes'}
-			# Format traffic accident injuries
-			elif formattedName == 'injuries' and not data[field].isdigit():
-				d[formattedName] = 0
+	for field, value in data.items():
+		# Get proper field names and types
+		name, converter = ATTRIBUTE_PLANS.get(field) or planAttribute(field)
+		if name == 'appearance_date' and value:
+			appeared = True
+		if not value:
+			# Empty fields are stored as NULL
+			if value == '':
+				value = None
+		elif converter:
+			try:
+				value = converter(value)
+			# Leave out values that can't be converted rather than losing the whole case on insert,
+			# counted in the drift report rather than printed since junk like 00/00/0000 is common
+			except ValueError:
+				dropped.append(('value', table, field))
+				value = None
+		i = index.get(name)
+		if i is not None:
+			values[i] = value
+		# Keep fields the table has no column for
+		else:
+			if overflow is None:
+				overflow = {}
+			overflow[name] = value
+			# Only count fields that had a value to lose
+			if value is not None:
+				dropped.append(('column' if field in ATTRIBUTE_MAP else 'label', table, field))
+	values.append(overflow)
 
 	# Assign attorneys a type based on what section they're in
-	if section.startswith('Attorney(s) for the '):
-		if d.get('appearance_date') or (d.get('name') and 'attorney' in d.get('name').lower()):
-			d['type'] = section[20:]
+	if attorneyType is not None:
+		name = getValue(values, index, 'name')
+		if appeared or (name and 'attorney' in name.lower()):
+			setValue(values, index, 'type', attorneyType)
 		# Discard party information in the attorney sections
 		else:
+			del dropped[droppedBefore:]
 			return None
 	# Assign officers a type to indicate that they're officers
-	elif header == 'parties' and ('Surety' in section or 'Bond' in section or 'Defendant' in section or 'Plaintiff' in section or 'Officer' in section):
-		d['type'] = section.replace(' Information', '')
+	elif partyType:
+		setValue(values, index, 'type', partyType)
+
+	return RECORDS[table]._make(values)
+
+# Get a field from record values, which end with the overflow map
+def getValue(values, index, name):
+	i = index.get(name)
+	if i is not None:
+		return values[i]
+	return values[-1].get(name) if values[-1] else None
 
-	return d
+# Set a field in record values
+def setValue(values, index, name, value):
+	i = index.get(name)
+	if i is not None:
+		values[i] = value
+	else:
+		if values[-1] is None:
+			values[-1] = {}
+		values[-1][name] = value
 
 def stripWhitespace(s):
 	return ' '.join(s.split())
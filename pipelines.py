@@ -5,7 +5,172 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+from twisted.enterprise import adbapi
+from twisted.internet import defer, task
+from md_court_scraper.items import SearchCellItem
+from md_court_scraper.rawhtml import createTables, loadDicts, Compressor
+
+
+# Buffer raw case pages and insert them in batches from a background thread
+# Completed search cells are written in the same transaction, after their cases
+# Run the spider with -a compress=zstd|zlib [-a compress_dict=ID] to store pages compressed
+# In recrawl mode a page replaces the stored one only if its hash changed, and is then marked for reparsing
+# After RAWCASES_MAX_RETRIES failed flushes in a row, pages are inserted one at a time and the ones that can't be are logged and skipped
+class RawCasesPipeline(object):
+    def __init__(self, stats, batchSize, flushInterval, maxRetries):
+        self.stats = stats
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxRetries = maxRetries
+        # Flushes in a row that failed
+        self.failures = 0
+        self.buffer = []
+        self.cells = []
+        # Flushes that haven't finished yet
+        self.pending = set()
+        self.dbpool = None
+        self.timer = None
+        self.compressor = None
+        self.recrawl = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            crawler.stats,
+            crawler.settings.getint('RAWCASES_BATCH_SIZE', 200),
+            crawler.settings.getfloat('RAWCASES_FLUSH_INTERVAL', 5),
+            crawler.settings.getint('RAWCASES_MAX_RETRIES', 3)
+        )
+
+    def open_spider(self, spider):
+        self.spider = spider
+        # One connection is enough since each flush is a single transaction
+        self.dbpool = adbapi.ConnectionPool('psycopg2', host=spider.dbhost, database=spider.db, user=spider.dbuser, password=spider.dbpassword, cp_min=1, cp_max=1, cp_reconnect=True)
+        # Flush partial batches on an interval
+        self.timer = task.LoopingCall(self.flush)
+        self.timer.start(self.flushInterval, now=False)
+        self.recrawl = bool(getattr(spider, 'recrawl', False))
+        if getattr(spider, 'compress', None):
+            return self.dbpool.runInteraction(self.createCompressor, spider.compress, getattr(spider, 'compress_dict', None))
+
+    # Set up compression with an optional stored dictionary, run inside the DB thread
+    def createCompressor(self, cur, codec, dict_id):
+        createTables(cur)
+        dictData = None
+        if dict_id:
+            dictData = loadDicts(cur)[int(dict_id)][1]
+        self.compressor = Compressor(codec, dictData=dictData)
+        self.spider.logger.info('Storing raw cases compressed with %s%s', codec, ' and dictionary %s' % dict_id if dict_id else '')
 
-class MdCourtScraperPipeline(object):
     def process_item(self, item, spider):
+        if isinstance(item, SearchCellItem):
+            self.cells.append((item['cell'],))
+            return item
+        self.buffer.append((item['case_id'], item['url'], item['html'], item['html_hash']))
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
         return item
+
+    # Hand everything buffered so far to the DB thread
+    def flush(self):
+        # Hold completed cells back while an earlier batch is in flight, so they're never committed ahead of pages it puts back
+        holdCells = bool(self.pending)
+        if not self.buffer and (holdCells or not self.cells):
+            return
+        rows = self.buffer
+        self.buffer = []
+        cells = []
+        if not holdCells:
+            cells = self.cells
+            self.cells = []
+        d = self.dbpool.runInteraction(self.insertRows, rows, cells, self.failures >= self.maxRetries)
+        d.addCallbacks(self.flushed, self.flushFailed, callbackArgs=(rows, cells), errbackArgs=(rows, cells))
+        self.pending.add(d)
+        d.addBoth(self.finished, d)
+
+    # Insert a batch in one statement and one commit, or a row at a time after repeated failures, run inside the DB thread
+    # Returns the seconds spent so the reactor thread can record them, the number of pages written, and the number skipped
+    def insertRows(self, cur, rows, cells, rowByRow):
+        start = time.time()
+        written = []
+        skipped = 0
+        if rows:
+            column, other = ('html_compressed', 'html') if self.compressor else ('html', 'html_compressed')
+            if self.compressor:
+                rows = [(case_id, url, self.compressor.compress(html), html_hash) for case_id, url, html, html_hash in rows]
+            conflict = 'DO NOTHING'
+            if self.recrawl:
+                conflict = 'DO UPDATE SET url = EXCLUDED.url, {0} = EXCLUDED.{0}, {1} = NULL, html_hash = EXCLUDED.html_hash, reparse = true WHERE rawcases.html_hash IS DISTINCT FROM EXCLUDED.html_hash'.format(column, other)
+            query = 'INSERT INTO rawcases (case_id, url, ' + column + ', html_hash) VALUES %s ON CONFLICT (case_id) ' + conflict + ' RETURNING case_id'
+            if rowByRow:
+                written, skipped = self.insertEach(cur, query, rows)
+            else:
+                written = execute_values(cur, query, rows, fetch=True)
+            if self.recrawl:
+                cur.execute('UPDATE rawcases SET fetched_at = now() WHERE case_id = ANY(%s)', ([row[0] for row in rows],))
+        # A cell is only complete if all its pages were saved
+        if cells and skipped:
+            self.spider.logger.warning('Leaving %s search cells incomplete since %s of their pages were skipped', len(cells), skipped)
+        elif cells:
+            execute_values(cur, 'INSERT INTO search_cells (cell) VALUES %s ON CONFLICT (cell) DO NOTHING', cells)
+        return time.time() - start, len(written), skipped
+
+    # Insert rows one at a time in savepoints, logging and skipping the ones that can't be inserted
+    # Bad pages, like ones with NUL characters, raise ValueError before they reach the database
+    def insertEach(self, cur, query, rows):
+        written = []
+        skipped = 0
+        for row in rows:
+            cur.execute('SAVEPOINT raw_case')
+            try:
+                written.extend(execute_values(cur, query, [row], fetch=True))
+            except (psycopg2.DataError, psycopg2.IntegrityError, ValueError) as error:
+                cur.execute('ROLLBACK TO SAVEPOINT raw_case')
+                self.spider.logger.error('Skipped raw case %s (%s): %s', row[0], row[1], str(error).strip())
+                skipped += 1
+                continue
+            cur.execute('RELEASE SAVEPOINT raw_case')
+        return written, skipped
+
+    def flushed(self, result, rows, cells):
+        elapsed, written, skipped = result
+        self.failures = 0
+        self.stats.inc_value('db/insert_seconds', elapsed)
+        if skipped:
+            self.stats.inc_value('rawcases/skipped', skipped)
+        if self.recrawl:
+            self.stats.inc_value('rawcases/changed', written)
+            self.spider.logger.info('Refetched %s raw cases, %s changed', len(rows), written)
+        else:
+            self.spider.logger.info('Inserted %s raw cases, completed %s search cells', len(rows) - skipped, 0 if skipped else len(cells))
+
+    # Put the rows back so the next flush retries them
+    def flushFailed(self, failure, rows, cells):
+        self.failures += 1
+        self.spider.logger.error('Failed to insert %s raw cases (%s failures in a row): %s', len(rows), self.failures, failure.getErrorMessage())
+        if self.failures == self.maxRetries:
+            self.spider.logger.warning('Inserting raw cases one at a time until a flush succeeds')
+        self.buffer[:0] = rows
+        self.cells[:0] = cells
+
+    def finished(self, result, d):
+        self.pending.discard(d)
+
+    # Flush what's left and wait for every batch before closing
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self.timer and self.timer.running:
+            self.timer.stop()
+        self.flush()
+        yield defer.DeferredList(list(self.pending))
+        # Try a failed last batch one more time, a row at a time so one bad page can't lose the rest
+        if self.buffer or self.cells:
+            self.failures = max(self.failures, self.maxRetries)
+            self.flush()
+            yield defer.DeferredList(list(self.pending))
+        if self.buffer:
+            spider.logger.critical('Lost %s raw cases that could not be inserted', len(self.buffer))
+        self.dbpool.close()
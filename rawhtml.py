@@ -0,0 +1,113 @@
+import re
+import zlib
+import hashlib
+
+# zstd is optional, zlib is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Largest preset dictionary zlib can use
+ZLIB_DICT_MAX = 32768
+
+# Shared compression dictionaries, referenced by ID from inside each compressed page
+DICTS_TABLE = 'CREATE TABLE IF NOT EXISTS rawcase_dicts (dict_id bigint PRIMARY KEY, codec text, data bytea)'
+
+# Compressed pages go here and leave rawcases.html NULL
+COMPRESSED_COLUMN = 'ALTER TABLE rawcases ADD COLUMN IF NOT EXISTS html_compressed bytea'
+
+# Where each page came from and when, so it can be fetched again, whether a newer version needs parsing,
+# and the content hash of the page and of the version last parsed
+RECRAWL_COLUMNS = 'ALTER TABLE rawcases ADD COLUMN IF NOT EXISTS url text, ADD COLUMN IF NOT EXISTS html_hash text, ADD COLUMN IF NOT EXISTS fetched_at timestamp DEFAULT now(), ADD COLUMN IF NOT EXISTS reparse boolean DEFAULT false, ADD COLUMN IF NOT EXISTS parsed_hash text'
+
+# Lets main.py claim marked cases without scanning every unmarked row
+REPARSE_INDEX = 'CREATE INDEX IF NOT EXISTS rawcases_reparse ON rawcases (case_id) WHERE reparse'
+
+# Parts of a page that change between fetches without the case changing:
+# comments, scripts and styles, session IDs in links, and hidden form values like tokens
+# Timestamps are left alone, since the dates and times on a case page are part of the case
+VOLATILE = re.compile(r'<!--.*?-->|<script\b.*?</script\s*>|<style\b.*?</style\s*>|;jsessionid=[^"\'?#>\s]*|(?<=<input)[^>]*type="?hidden"?[^>]*', re.IGNORECASE | re.DOTALL)
+WHITESPACE = re.compile(r'\s+')
+BETWEEN_TAGS = re.compile(r'>\s+<')
+
+# Make sure the dictionary table and extra rawcases columns exist
+def createTables(cur):
+    cur.execute(DICTS_TABLE)
+    cur.execute(COMPRESSED_COLUMN)
+    cur.execute(RECRAWL_COLUMNS)
+    cur.execute(REPARSE_INDEX)
+
+# Get the hash a page's content is compared by, ignoring volatile parts and whitespace
+def contentHash(html):
+    normalized = BETWEEN_TAGS.sub('><', WHITESPACE.sub(' ', VOLATILE.sub('', html)))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+# Get the ID a compressed page refers to its dictionary by
+def getDictId(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressionDict(data).dict_id()
+    return zlib.adler32(data)
+
+# Store a dictionary and return its ID
+def saveDict(cur, codec, data):
+    dict_id = getDictId(codec, data)
+    cur.execute('INSERT INTO rawcase_dicts (dict_id, codec, data) VALUES (%s, %s, %s) ON CONFLICT (dict_id) DO NOTHING', (dict_id, codec, data))
+    return dict_id
+
+# Get every stored dictionary as {dict_id: (codec, data)}
+def loadDicts(cur):
+    cur.execute('SELECT dict_id, codec, data FROM rawcase_dicts')
+    return {dict_id: (codec, bytes(data)) for dict_id, codec, data in cur.fetchall()}
+
+# Compress pages with one codec and an optional dictionary
+class Compressor(object):
+    def __init__(self, codec='zstd', level=None, dictData=None):
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for zstd compression')
+        self.codec = codec
+        self.dictData = dictData
+        if codec == 'zstd':
+            zdict = zstandard.ZstdCompressionDict(dictData) if dictData else None
+            self.compressor = zstandard.ZstdCompressor(level=level or 10, dict_data=zdict)
+        else:
+            self.level = level or 9
+
+    def compress(self, html):
+        data = html.encode('utf-8')
+        if self.codec == 'zstd':
+            return self.compressor.compress(data)
+        if self.dictData:
+            compressor = zlib.compressobj(self.level, zdict=self.dictData)
+            return compressor.compress(data) + compressor.flush()
+        return zlib.compress(data, self.level)
+
+# Decompress pages from any codec, finding dictionaries by the ID in each page
+class Decompressor(object):
+    def __init__(self, dicts=None):
+        self.dicts = dicts or {}
+        self.zstdDicts = {}
+        for dict_id, (codec, data) in self.dicts.items():
+            if codec == 'zstd' and zstandard is not None:
+                self.zstdDicts[dict_id] = zstandard.ZstdCompressionDict(data)
+
+    def decompress(self, blob):
+        blob = bytes(blob)
+        if blob[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ImportError('zstandard is required to read zstd pages')
+            dict_id = zstandard.get_frame_parameters(blob).dict_id
+            # Decompressors aren't thread safe, so make one per page
+            decompressor = zstandard.ZstdDecompressor(dict_data=self.zstdDicts[dict_id]) if dict_id else zstandard.ZstdDecompressor()
+            return decompressor.decompress(blob).decode('utf-8')
+        # The zlib FDICT flag is followed by the dictionary's Adler-32
+        if blob[1] & 0x20:
+            decompressor = zlib.decompressobj(zdict=self.dicts[int.from_bytes(blob[2:6], 'big')][1])
+            return (decompressor.decompress(blob) + decompressor.flush()).decode('utf-8')
+        return zlib.decompress(blob).decode('utf-8')
+
+    # Get a page's HTML whether or not it was stored compressed
+    def getHtml(self, html, blob):
+        return html if blob is None else self.decompress(blob)
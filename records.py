@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+# Field tuples for each table
+TABLE_COLS = {
+    'cases': ('case_id', 'title', 'court_system', 'type', 'filing_date', 'status', 'disposition', 'disposition_date', 'violation_county', 'violation_date'),
+    'parties': ('case_id', 'name', 'type', 'bus_org_name', 'agency_name', 'race', 'sex', 'height', 'weight', 'dob', 'address', 'city', 'state', 'zip'),
+    'attorneys': ('case_id', 'name', 'type', 'appearance_date', 'removal_date', 'practice_name', 'address', 'city', 'state', 'zip'),
+    'events': ('case_id', 'type', 'date', 'time', 'result', 'result_date'),
+    'charges': ('case_id', 'statute_code', 'description', 'offense_date_from', 'offense_date_to', 'class', 'amended_date', 'cjis_code', 'probable_cause', 'victim_age', 'speed_limit', 'recorded_speed', 'location_stopped', 'accident_contribution', 'injuries', 'property_damage', 'seatbelts_used', 'mandatory_court_appearance', 'vehicle_tag', 'state', 'plea', 'plea_date', 'disposition', 'disposition_date', 'jail_extreme_punishment', 'jail_term', 'jail_suspended_term', 'jail_unsuspended_term', 'probation_term', 'probation_supervised_term', 'probation_unsupervised_term', 'fine_amt', 'fine_suspended_amt', 'fine_restitution_amt', 'fine_due', 'fine_first_pmt_due', 'cws_hours', 'cws_deadline', 'cws_location', 'cws_date'),
+    'documents': ('case_id', 'name', 'filing_date'),
+    'judgements': ('case_id', 'against', 'in_favor_of', 'type', 'date', 'interest', 'amt'),
+    'complaints': ('case_id', 'type', 'against', 'status', 'status_date', 'filing_date', 'amt')
+}
+
+# One record type per table, holding the table's columns in order plus an overflow map of fields the table has no column for
+# Records are tuples, so a row to insert is just the case ID and a slice
+RECORDS = {table: namedtuple(table.title() + 'Record', columns + ('overflow',), rename=True, module=__name__) for table, columns in TABLE_COLS.items()}
+# Column positions for each table
+COLUMN_INDEX = {table: {column: i for i, column in enumerate(columns)} for table, columns in TABLE_COLS.items()}
+# Let records be pickled, which looks their types up by name in this module
+globals().update({record.__name__: record for record in RECORDS.values()})
+
+# Make a record from a {field: value} map
+def makeRecord(table, fields):
+    index = COLUMN_INDEX[table]
+    values = [None] * len(index)
+    overflow = None
+    for name, value in fields.items():
+        i = index.get(name)
+        if i is None:
+            if overflow is None:
+                overflow = {}
+            overflow[name] = value
+        else:
+            values[i] = value
+    values.append(overflow)
+    return RECORDS[table]._make(values)
+
+# Get the fields that are set in a record as a {field: value} map
+def recordDict(record, table):
+    fields = {column: value for column, value in zip(TABLE_COLS[table], record) if value is not None}
+    if record[-1]:
+        fields.update((name, value) for name, value in record[-1].items() if value is not None)
+    return fields
+
+# Get a parsed case as {table: [{field: value}]}
+def outputDict(output):
+    return {table: [recordDict(record, table) for record in records] for table, records in output.items()}
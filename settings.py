@@ -52,27 +52,67 @@ ROBOTSTXT_OBEY = True
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
-    'scrapy.spidermiddlewares.referer.RefererMiddleware': None
+    'scrapy.spidermiddlewares.referer.RefererMiddleware': None,
+    'md_court_scraper.middlewares.CrawlMetricsMiddleware': 543,
 }
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
-
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'md_court_scraper.middlewares.BackoffRetryMiddleware': 550,
 }
 
+# Retries after the first attempt, statuses to retry, and seconds to back off, doubling up to the max
+# Statuses in RETRY_STATUS_DELAYS wait at least that long, other error statuses aren't retried
+RETRY_TIMES = 5
+RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429]
+RETRY_BACKOFF_BASE = 1
+RETRY_BACKOFF_MAX = 60
+RETRY_STATUS_DELAYS = {429: 30, 503: 5}
+
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'md_court_scraper.extensions.AdaptiveThrottle': 500,
+}
+
+# Start at CONCURRENT_REQUESTS and adjust between the floor and ceiling, adding up to
+# ADAPTIVE_MAX_DELAY seconds of delay when the floor is still too much for the site
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_CONCURRENCY_MIN = 4
+ADAPTIVE_CONCURRENCY_MAX = 64
+ADAPTIVE_MAX_DELAY = 10
+# A window with higher average latency or error rate than these backs off
+ADAPTIVE_TARGET_LATENCY = 2.0
+ADAPTIVE_ERROR_RATE = 0.05
+# Seconds between adjustments, and the responses a window needs to count
+ADAPTIVE_INTERVAL = 5
+ADAPTIVE_MIN_SAMPLES = 20
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'md_court_scraper.pipelines.MdCourtScraperPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'md_court_scraper.pipelines.RawCasesPipeline': 300,
+}
+
+# Raw cases per insert, and seconds between flushes of partial batches
+RAWCASES_BATCH_SIZE = 200
+RAWCASES_FLUSH_INTERVAL = 5
+# Failed flushes in a row before raw cases are inserted one at a time, skipping the ones that can't be
+RAWCASES_MAX_RETRIES = 3
+
+# The site cuts results off at this many, so searches that reach it get split
+SEARCH_RESULT_LIMIT = 500
+# Skip searches that have come back empty this many times before (0 to never skip)
+SEARCH_SKIP_EMPTY_AFTER = 30
+
+# Crawl metrics export, as 'jsonl' or 'prometheus', every METRICS_INTERVAL seconds
+METRICS_FILE = 'crawl-metrics.jsonl'
+METRICS_FORMAT = 'jsonl'
+METRICS_INTERVAL = 10
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html